@@ -1,4 +1,4 @@
 from .diffuse import DiffusionModelConfig, ControlDiffusionModelConfig, Txt2ImgParams, Img2ImgParams, Ctrl2ImgParams
 from .diffuse import txt2img, img2img, ctrl2img
 from .context import progress_tracking, intermediates
-from .loader import unload_all_models
\ No newline at end of file
+from .loader import unload_all_models, convert_checkpoint_to_safetensors
\ No newline at end of file
@@ -35,7 +35,7 @@ def txt2img(config: DiffusionModelConfig, params: Txt2ImgParams):
 
 	sampler.use_model(model)
 
-	with torch.no_grad(), torch.autocast('cuda'):
+	with torch.inference_mode(), torch.autocast('cuda'):
 		denoising_steps = params.steps
 		ctx.report_sampling_steps(denoising_steps)
 
@@ -108,7 +108,7 @@ def img2img(config: DiffusionModelConfig, params: Img2ImgParams, image: Image, m
 	assert mask is not None if model.is_inpainting_model else True, 'the loaded model is an inpainting model and thus needs a mask'
 
 
-	with torch.no_grad(), torch.autocast('cuda'):
+	with torch.inference_mode(), torch.autocast('cuda'):
 		denoising_steps = int(
 			min(params.denoising_strength, 0.999) 
 			* params.steps
@@ -209,7 +209,7 @@ def ctrl2img(config: ControlDiffusionModelConfig, params: Ctrl2ImgParams, contro
 	assert mask is not None if model.is_inpainting_model else True, 'the loaded model is an inpainting model and thus needs a mask'
 
 
-	with torch.no_grad(), torch.autocast('cuda'):
+	with torch.inference_mode(), torch.autocast('cuda'):
 		ctx.report_sampling_steps(params.steps)
 		ctx.report_stage('encode')
 
@@ -1,8 +1,13 @@
+import os
 import torch
 import numpy as np
 from PIL import Image
 
 
+_LANCZOS = getattr(Image, 'Resampling', Image).LANCZOS
+_NEAREST = getattr(Image, 'Resampling', Image).NEAREST
+
+
 def image_to_tensor(image):
 	image = image.convert('RGB')
 	image = np.array(image, dtype=np.float32)
@@ -29,12 +34,28 @@ def mask_to_tensor(mask):
 
 
 
+def _is_reopenable(im):
+	# relative paths may resolve elsewhere by now, and deleted files can't be reopened at all
+	filename = getattr(im, 'filename', None)
+	return bool(filename) and os.path.isabs(filename) and os.path.isfile(filename)
+
+
 def resize_image(im, width, height, mode='stretch'):
 	if im.width == width and im.height == height:
 		return im
 
+	if im.format == 'JPEG' and im.tile and _is_reopenable(im):
+		# let libjpeg downscale in the DCT domain first, keeping 2x headroom for lanczos.
+		# draft() works in place, so it goes on our own handle of the file, never the caller's image.
+		# the caller's mode is kept, in case they drafted it themselves
+		mode_draft = im.mode
+		im = Image.open(im.filename)
+		im.draft(mode_draft, (width * 2, height * 2))
+
+	# pillow-simd can be installed as a drop-in replacement for Pillow to get
+	# SSE4/AVX2 accelerated resampling here
 	if mode == 'stretch':
-		res = im.resize((width, height), resample=Image.LANCZOS)
+		res = im.resize((width, height), resample=_LANCZOS)
 	elif mode == 'pad':
 		ratio = width / height
 		src_ratio = im.width / im.height
@@ -42,7 +63,7 @@ def resize_image(im, width, height, mode='stretch'):
 		src_w = width if ratio > src_ratio else im.width * height // im.height
 		src_h = height if ratio <= src_ratio else im.height * width // im.width
 
-		resized = im.resize((src_w, src_h), resample=Image.LANCZOS)
+		resized = im.resize((src_w, src_h), resample=_LANCZOS)
 		res = Image.new("RGBA", (width, height))
 		res.paste(resized, box=(width // 2 - src_w // 2, height // 2 - src_h // 2))
 	elif mode == 'repeat':
@@ -52,17 +73,23 @@ def resize_image(im, width, height, mode='stretch'):
 		src_w = width if ratio < src_ratio else im.width * height // im.height
 		src_h = height if ratio >= src_ratio else im.height * width // im.width
 
-		resized = im.resize((src_w, src_h), resample=Image.LANCZOS)
+		resized = im.resize((src_w, src_h), resample=_LANCZOS)
 		res = Image.new("RGBA", (width, height))
 		res.paste(resized, box=(width // 2 - src_w // 2, height // 2 - src_h // 2))
 
+		# edge fills just replicate the outermost row/column. cropped and stretched in PIL
+		# so the image mode (and palette) carries over
 		if ratio < src_ratio:
 			fill_height = height // 2 - src_h // 2
-			res.paste(resized.resize((width, fill_height), box=(0, 0, width, 0)), box=(0, 0))
-			res.paste(resized.resize((width, fill_height), box=(0, resized.height, width, resized.height)), box=(0, fill_height + src_h))
+			top = resized.crop((0, 0, resized.width, 1))
+			bottom = resized.crop((0, resized.height - 1, resized.width, resized.height))
+			res.paste(top.resize((width, fill_height), resample=_NEAREST), box=(0, 0))
+			res.paste(bottom.resize((width, fill_height), resample=_NEAREST), box=(0, fill_height + src_h))
 		elif ratio > src_ratio:
 			fill_width = width // 2 - src_w // 2
-			res.paste(resized.resize((fill_width, height), box=(0, 0, 0, height)), box=(0, 0))
-			res.paste(resized.resize((fill_width, height), box=(resized.width, 0, resized.width, height)), box=(fill_width + src_w, 0))
+			left = resized.crop((0, 0, 1, resized.height))
+			right = resized.crop((resized.width - 1, 0, resized.width, resized.height))
+			res.paste(left.resize((fill_width, height), resample=_NEAREST), box=(0, 0))
+			res.paste(right.resize((fill_width, height), resample=_NEAREST), box=(fill_width + src_w, 0))
 
 	return res
\ No newline at end of file
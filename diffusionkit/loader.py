@@ -1,11 +1,17 @@
 import torch
 import gc
-from safetensors import safe_open
+import os
+import pickle
+from safetensors.torch import load_file, save_file
 from .modules.diffusion.ddpm import LatentDiffusion
 from .modules.diffusion.openaimodel import UNetModel
 from .modules.autoencoder import AutoencoderKL
 from .modules.encoders import FrozenCLIPEmbedder, FrozenOpenCLIPEmbedder
 from .modules.controlnet import ControlLDM, ControlNet, ControlledUNetModel
+from .modules.utils import compile_with_fallback
+
+TORCH_VERSION = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+TORCH_HAS_MMAP_LOAD = TORCH_VERSION >= (2, 1) # mmap= for torch.load, assign= for load_state_dict
 
 models = dict()
 
@@ -15,12 +21,9 @@ def load_stable_diffusion(config, controlnet=False):
 		return models[config.checkpoint_sd]
 
 	if '.safetensor' in config.checkpoint_sd:
-		state_dict = {}
-		with safe_open(config.checkpoint_sd, framework='pt', device='cpu') as f:
-			for key in f.keys():
-				state_dict[key] = f.get_tensor(key)
+		state_dict = load_file(config.checkpoint_sd, device='cpu')
 	else:
-		checkpoint = torch.load(config.checkpoint_sd, map_location='cpu')
+		checkpoint = load_checkpoint(config.checkpoint_sd)
 		state_dict = checkpoint['state_dict'] if 'state_dict' in checkpoint else checkpoint
 
 	is_v2_model, is_inpainting_model = guess_stable_diffusion_version(state_dict)
@@ -161,17 +164,90 @@ def load_stable_diffusion(config, controlnet=False):
 
 	print(state_dict['model.diffusion_model.input_blocks.1.0.out_layers.3.weight'].dtype)
 
-	model.load_state_dict(state_dict, strict=False)
+	if TORCH_HAS_MMAP_LOAD:
+		match_non_float_dtypes(model, state_dict)
+
+	model.load_state_dict(
+		state_dict,
+		strict=False,
+		**(
+			{
+				'assign': True
+			} if TORCH_HAS_MMAP_LOAD else {
+			}
+		)
+	)
 	model.is_inpainting_model = is_inpainting_model
 	model.is_v_model = is_v_model
 
-	model.half()
-	model.cuda()
+	model.to(device='cuda', dtype=torch.float16, non_blocking=True)
+	torch.cuda.synchronize()
 	model.eval()
 
+	compile_first_stage(model)
+
 	return model
 
 
+def compile_first_stage(model):
+	model.decode_first_stage = compile_with_fallback(
+		model.decode_first_stage,
+		mode='reduce-overhead',
+		fullgraph=False,
+		dynamic=False
+	)
+
+	# no cuda graphs here, the returned distribution would alias buffers the next encode overwrites
+	model.encode_first_stage = compile_with_fallback(
+		model.encode_first_stage,
+		fullgraph=False
+	)
+
+
+def match_non_float_dtypes(model, state_dict):
+	# assign=True adopts checkpoint tensors as they are, skipping the dtype-preserving copy.
+	# integer buffers stored as floats (e.g. clip position_ids in some merges) must be cast back
+	own_state = model.state_dict()
+
+	for key, value in state_dict.items():
+		if key not in own_state or own_state[key].is_floating_point():
+			continue
+
+		if value.dtype != own_state[key].dtype:
+			state_dict[key] = value.to(own_state[key].dtype)
+
+
+def load_checkpoint(path):
+	if not TORCH_HAS_MMAP_LOAD:
+		return torch.load(path, map_location='cpu')
+
+	try:
+		return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+	except (RuntimeError, pickle.UnpicklingError):
+		# legacy (non-zip) checkpoints can't be mmapped, and some pickle training state
+		return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def convert_checkpoint_to_safetensors(checkpoint_path, output_path=None):
+	if output_path is None:
+		output_path = os.path.splitext(checkpoint_path)[0] + '.safetensors'
+
+	checkpoint = load_checkpoint(checkpoint_path)
+	state_dict = checkpoint['state_dict'] if 'state_dict' in checkpoint else checkpoint
+
+	# safetensors refuses tensors that share storage, so every tensor gets its own copy
+	save_file(
+		{
+			key: value.detach().clone().contiguous()
+			for key, value in state_dict.items()
+			if isinstance(value, torch.Tensor)
+		},
+		output_path
+	)
+
+	return output_path
+
+
 def guess_stable_diffusion_version(state_dict):
 	is_v2 = state_dict['model.diffusion_model.input_blocks.1.1.transformer_blocks.0.attn2.to_k.weight'].shape[1] == 1024
 	is_inpainting = state_dict['model.diffusion_model.input_blocks.0.0.weight'].shape[1] == 9
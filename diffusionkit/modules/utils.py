@@ -1,88 +1,158 @@
+import math
 import torch
 import importlib
 import numpy as np
-import multiprocessing as mp
-from collections import abc
-from threading import Thread
-from queue import Queue
+from functools import lru_cache, partial, wraps
+from collections import abc, namedtuple
 from inspect import isfunction
-from PIL import Image, ImageDraw, ImageFont
-from scipy import integrate
+from PIL import Image
+from numpy.polynomial import polynomial
 
 
-def latent_to_images(latent, model):
-	x_samples = model.decode_first_stage(latent)
-	images = []
+def compile_with_fallback(func, **compile_args):
+	"""Wraps func with torch.compile on its first call, falling back to eager if compiling fails before
+	the first success, e.g. on platforms dynamo doesn't support or without an inductor/triton backend."""
+	if not hasattr(torch, 'compile'):
+		return func
 
-	for i in range(len(x_samples)):
-		x_sample = x_samples[i]
-		x_sample = torch.clamp((x_sample + 1.0) / 2.0, min=0.0, max=1.0)
-		x_sample = x_sample.cpu().numpy()
-		x_sample = 255. * np.transpose(x_sample, (1, 2, 0))
-		x_sample = x_sample.astype(np.uint8)
-		
-		image = Image.fromarray(x_sample)
-		images.append(image)
-	
-	return images
+	target = None
 
+	@wraps(func)
+	def call(*args, **kwargs):
+		nonlocal target
+		if target is not None:
+			return target(*args, **kwargs)
+		try:
+			# compiling here rather than at wrap time keeps torch._dynamo out of import
+			compiled = torch.compile(func, **compile_args)
+			result = compiled(*args, **kwargs)
+		except Exception as e:
+			print(f'torch.compile failed for {func.__name__}, running eagerly: {e}')
+			target = func
+			return func(*args, **kwargs)
+		target = compiled
+		return result
+
+	return call
+
+
+def _script_on_first_use(func):
+	"""Compiles func with torch.jit.script on its first call if CUDA is available, so importing stays cheap."""
+	scripted = None
+
+	@wraps(func)
+	def call(*args):
+		nonlocal scripted
+		if scripted is None:
+			scripted = torch.jit.script(func) if torch.cuda.is_available() else func
+		return scripted(*args)
+
+	return call
+
+
+def latent_to_images(latent, model, return_tensors=False):
+	with torch.inference_mode():
+		x_samples = model.decode_first_stage(latent)
+		x_samples = _to_uint8_nhwc(x_samples)
+
+		if return_tensors:
+			# uint8 NHWC, left on the device
+			return x_samples
+
+		x_samples = x_samples.cpu().numpy()
+
+	return [Image.fromarray(x_samples[i]) for i in range(x_samples.shape[0])]
+
+
+def _to_uint8_nhwc(x):
+	# clamp() makes the only copy, the decoder output itself must not be mutated
+	x = x.clamp(-1, 1).add_(1).mul_(127.5)
+	return x.to(torch.uint8).permute(0, 2, 3, 1).contiguous()
 
+# fused into a single elementwise + transpose kernel. not using cuda graphs here,
+# since the output has to stay valid after the next call
+_to_uint8_nhwc = compile_with_fallback(_to_uint8_nhwc)
+
+
+@_script_on_first_use
 def to_d(x, sigma, denoised):
 	'''Converts a denoiser output to a Karras ODE derivative.'''
-	return (x - denoised) / append_dims(sigma, x.ndim)
+	# append_dims inlined: scripted, its ValueError would surface as a torch.jit.Error
+	for _ in range(x.dim() - sigma.dim()):
+		sigma = sigma.unsqueeze(-1)
+	return (x - denoised) / sigma
 
 def linear_multistep_coeff(order, t, i, j):
     if order - 1 > i:
         raise ValueError(f'Order {order} too high for step {i}')
-    def fn(tau):
-        prod = 1.
-        for k in range(order):
-            if j == k:
-                continue
-            prod *= (tau - t[i - k]) / (t[i - j] - t[i - k])
-        return prod
-    return integrate.quad(fn, t[i], t[i + 1], epsrel=1e-4)[0]
+    nodes = tuple(float(t[i - k]) for k in range(order))
+    return _lagrange_basis_integral(nodes, j, float(t[i]), float(t[i + 1]))
+
+@lru_cache(maxsize=1024)
+def _lagrange_basis_integral(nodes, j, a, b):
+    """Integrates the j-th Lagrange basis polynomial over the given nodes from a to b."""
+    coeffs = np.ones(1)
+    for k, node in enumerate(nodes):
+        if j == k:
+            continue
+        coeffs = polynomial.polymul(coeffs, (-node, 1.)) / (nodes[j] - node)
+    antiderivative = polynomial.polyint(coeffs)
+    return float(polynomial.polyval(b, antiderivative) - polynomial.polyval(a, antiderivative))
 
 def get_ancestral_step(sigma_from, sigma_to, eta=1.):
     """Calculates the noise level (sigma_down) to step down to and the amount
     of noise to add (sigma_up) when doing an ancestral sampling step."""
+    is_tensor = isinstance(sigma_from, torch.Tensor) or isinstance(sigma_to, torch.Tensor)
+    if is_tensor:
+        sigma_from = torch.as_tensor(sigma_from)
+        sigma_to = torch.as_tensor(sigma_to)
     if not eta:
-        return sigma_to, 0.
-    sigma_up = min(sigma_to, eta * (sigma_to ** 2 * (sigma_from ** 2 - sigma_to ** 2) / sigma_from ** 2) ** 0.5)
-    sigma_down = (sigma_to ** 2 - sigma_up ** 2) ** 0.5
+        return sigma_to, (torch.zeros_like(sigma_to) if is_tensor else 0.)
+    sqrt, minimum = (torch.sqrt, torch.minimum) if is_tensor else (math.sqrt, min)
+    sf2 = sigma_from * sigma_from
+    st2 = sigma_to * sigma_to
+    sigma_up = minimum(sigma_to, sqrt(eta * eta * st2 * (sf2 - st2) / sf2))
+    sigma_down = sqrt(st2 - sigma_up * sigma_up)
     return sigma_down, sigma_up
 
 
+@_script_on_first_use
 def append_zero(x):
 	return torch.cat([x, x.new_zeros([1])])
 
-def append_dims(x, target_dims):
+def append_dims(x, target_dims: int):
 	"""Appends dimensions to the end of a tensor until it has target_dims dimensions."""
-	dims_to_append = target_dims - x.ndim
+	dims_to_append = target_dims - x.dim()
 	if dims_to_append < 0:
-		raise ValueError(f'input has {x.ndim} dims but target_dims is {target_dims}, which is less')
-	return x[(...,) + (None,) * dims_to_append]
+		raise ValueError(f'input has {x.dim()} dims but target_dims is {target_dims}, which is less')
+	for _ in range(dims_to_append):
+		x = x.unsqueeze(-1)
+	return x
 
 def create_random_tensors(shape, seeds):
-	xs = []
+	xs = torch.empty((len(seeds), *shape), device='cpu')
 
-	for seed in seeds:
+	for i, seed in enumerate(seeds):
+		# seeds every device, the samplers rely on this for their per-step cuda noise
 		torch.manual_seed(seed)
-		xs.append(torch.randn(shape, device='cpu'))
+		torch.randn(shape, out=xs[i])
 
-	return torch.stack(xs)
+	return xs
 
 
 def log_txt_as_img(wh, xc, size=10):
 	# wh a tuple of (width, height)
 	# xc a list of captions to plot
+	from PIL import ImageDraw, ImageFont
+
 	b = len(xc)
-	txts = list()
+	txts = np.empty((b, 3, wh[1], wh[0]), dtype=np.float32)
+	font = ImageFont.truetype('data/DejaVuSans.ttf', size=size)
+	nc = int(40 * (wh[0] / 256))
+
 	for bi in range(b):
 		txt = Image.new("RGB", wh, color="white")
 		draw = ImageDraw.Draw(txt)
-		font = ImageFont.truetype('data/DejaVuSans.ttf', size=size)
-		nc = int(40 * (wh[0] / 256))
 		lines = "\n".join(xc[bi][start:start + nc] for start in range(0, len(xc[bi]), nc))
 
 		try:
@@ -90,11 +160,11 @@ def log_txt_as_img(wh, xc, size=10):
 		except UnicodeEncodeError:
 			print("Cant encode string for logging. Skipping.")
 
-		txt = np.array(txt).transpose(2, 0, 1) / 127.5 - 1.0
-		txts.append(txt)
-	txts = np.stack(txts)
-	txts = torch.tensor(txts)
-	return txts
+		txts[bi] = np.asarray(txt).transpose(2, 0, 1)
+
+	np.multiply(txts, 1.0 / 127.5, out=txts)
+	np.subtract(txts, 1.0, out=txts)
+	return torch.from_numpy(txts)
 
 
 def ismap(x):
@@ -119,12 +189,13 @@ def default(val, d):
 	return d() if isfunction(d) else d
 
 
+@_script_on_first_use
 def mean_flat(tensor):
 	"""
 	https://github.com/openai/guided-diffusion/blob/27c20a8fab9cb472df5d6bdd6c8d11c8f430b924/guided_diffusion/nn.py#L86
 	Take the mean over all non-batch dimensions.
 	"""
-	return tensor.mean(dim=list(range(1, len(tensor.shape))))
+	return tensor.flatten(1).mean(dim=1)
 
 
 def count_params(model, verbose=False):
@@ -145,28 +216,81 @@ def instantiate_from_config(config):
 
 
 def get_obj_from_str(string, reload=False):
+	if not reload:
+		return _get_cached_obj_from_str(string)
 	module, cls = string.rsplit(".", 1)
-	if reload:
-		module_imp = importlib.import_module(module)
-		importlib.reload(module_imp)
+	module_imp = importlib.import_module(module)
+	importlib.reload(module_imp)
+	_get_cached_obj_from_str.cache_clear()
 	return getattr(importlib.import_module(module, package=None), cls)
 
 
-def _do_parallel_data_prefetch(func, Q, data, idx, idx_to_fn=False):
-	# create dummy dataset instance
+@lru_cache(maxsize=None)
+def _get_cached_obj_from_str(string):
+	module, cls = string.rsplit(".", 1)
+	return getattr(importlib.import_module(module, package=None), cls)
+
+
+_SharedArray = namedtuple('_SharedArray', ['name', 'shape', 'dtype'])
+
+
+def _to_shared_array(arr):
+	from multiprocessing.shared_memory import SharedMemory
+
+	shm = SharedMemory(create=True, size=arr.nbytes)
+	np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+	shm.close()
+	return _SharedArray(shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach_shared_array(ref):
+	from multiprocessing.shared_memory import SharedMemory
+
+	shm = SharedMemory(name=ref.name)
+	return shm, np.ndarray(ref.shape, dtype=ref.dtype, buffer=shm.buf)
+
+
+def _release_shared_array(shm):
+	shm.close()
+	shm.unlink()
+
+
+_prefetch_func = None
+
+
+def _worker_init(func):
+	# stash func once per worker process rather than pickling it along with every split
+	global _prefetch_func
+	_prefetch_func = func
+
+
+def _worker_apply(args):
+	return _do_parallel_data_prefetch(_prefetch_func, args)
+
+
+def _do_parallel_data_prefetch(func, args):
+	data, idx, idx_to_fn, use_shared_memory = args
 
 	# run prefetching
 	if idx_to_fn:
 		res = func(data, worker_id=idx)
 	else:
 		res = func(data)
-	Q.put([idx, res])
-	Q.put("Done")
+
+	# hand large arrays back through shared memory instead of pickling them.
+	# object arrays only hold pointers into this process, those still have to be pickled
+	if use_shared_memory and isinstance(res, np.ndarray) and res.nbytes > 0 and not res.dtype.hasobject:
+		res = _to_shared_array(res)
+
+	return res
 
 
 def parallel_data_prefetch(
 		func: callable, data, n_proc, target_data_type="ndarray", cpu_intensive=True, use_worker_id=False
 ):
+	from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+	from multiprocessing import resource_tracker
+
 	# if target_data_type not in ["ndarray", "list"]:
 	#     raise ValueError(
 	#         "Data, which is passed to parallel_data_prefetch has to be either of type list or ndarray."
@@ -188,75 +312,77 @@ def parallel_data_prefetch(
 			f"The data, that shall be processed parallel has to be either an np.ndarray or an Iterable, but is actually {type(data)}."
 		)
 
-	if cpu_intensive:
-		Q = mp.Queue(1000)
-		proc = mp.Process
-	else:
-		Q = Queue(1000)
-		proc = Thread
-	# spawn processes
+	use_shared_memory = cpu_intensive and target_data_type == "ndarray"
+
+	if use_shared_memory:
+		# workers must share our tracker, else theirs unlinks the result buffers on exit
+		resource_tracker.ensure_running()
+
 	if target_data_type == "ndarray":
-		arguments = [
-			[func, Q, part, i, use_worker_id]
-			for i, part in enumerate(np.array_split(data, n_proc))
-		]
+		splits = np.array_split(data, n_proc)
 	else:
 		step = (
 			int(len(data) / n_proc + 1)
 			if len(data) % n_proc != 0
 			else int(len(data) / n_proc)
 		)
-		arguments = [
-			[func, Q, part, i, use_worker_id]
-			for i, part in enumerate(
-				[data[i: i + step] for i in range(0, len(data), step)]
-			)
-		]
-	processes = []
-	for i in range(n_proc):
-		p = proc(target=_do_parallel_data_prefetch, args=arguments[i])
-		processes += [p]
+		splits = [data[i: i + step] for i in range(0, len(data), step)]
+
+	arguments = [
+		(part, i, use_worker_id, use_shared_memory)
+		for i, part in enumerate(splits)
+	]
 
-	# start processes
 	print(f"Start prefetching...")
 	import time
 
 	start = time.time()
-	gather_res = [[] for _ in range(n_proc)]
+	futures = []
 	try:
-		for p in processes:
-			p.start()
-
-		k = 0
-		while k < n_proc:
-			# get result
-			res = Q.get()
-			if res == "Done":
-				k += 1
-			else:
-				gather_res[res[0]] = res[1]
+		if cpu_intensive:
+			executor = ProcessPoolExecutor(max_workers=n_proc, initializer=_worker_init, initargs=(func,))
+			task = _worker_apply
+		else:
+			# threads share our globals, so func is passed along directly
+			executor = ThreadPoolExecutor(max_workers=n_proc)
+			task = partial(_do_parallel_data_prefetch, func)
 
+		with executor as ex:
+			futures = [ex.submit(task, args) for args in arguments]
+		gather_res = [f.result() for f in futures]
 	except Exception as e:
 		print("Exception: ", e)
-		for p in processes:
-			p.terminate()
-
+		# blocks handed back by the workers that did finish would otherwise never be unlinked
+		for f in futures:
+			if f.done() and not f.cancelled() and f.exception() is None and isinstance(f.result(), _SharedArray):
+				_release_shared_array(_attach_shared_array(f.result())[0])
 		raise e
 	finally:
-		for p in processes:
-			p.join()
 		print(f"Prefetching complete. [{time.time() - start} sec.]")
 
-	if target_data_type == 'ndarray':
-		if not isinstance(gather_res[0], np.ndarray):
-			return np.concatenate([np.asarray(r) for r in gather_res], axis=0)
-
-		# order outputs
-		return np.concatenate(gather_res, axis=0)
-	elif target_data_type == 'list':
-		out = []
-		for r in gather_res:
-			out.extend(r)
-		return out
-	else:
-		return gather_res
\ No newline at end of file
+	shms = []
+	try:
+		# concatenate straight from the shared blocks, that is the only copy out of them
+		for i, r in enumerate(gather_res):
+			if isinstance(r, _SharedArray):
+				shm, gather_res[i] = _attach_shared_array(r)
+				shms.append(shm)
+
+		if target_data_type == 'ndarray':
+			if not isinstance(gather_res[0], np.ndarray):
+				return np.concatenate([np.asarray(r) for r in gather_res], axis=0)
+
+			# order outputs
+			return np.concatenate(gather_res, axis=0)
+		elif target_data_type == 'list':
+			out = []
+			for r in gather_res:
+				out.extend(r)
+			return out
+		else:
+			return gather_res
+	finally:
+		# the views have to be gone before the blocks can be closed
+		del gather_res
+		for shm in shms:
+			_release_shared_array(shm)
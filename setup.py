@@ -11,7 +11,6 @@ setup(
 	],
 	install_requires=[
 		'Pillow',
-		'scipy',
 		'einops',
 		'transformers>=4.25.1',
 		'open-clip-torch==2.7.0',